@@ -3,22 +3,40 @@ import logging
 import boto3
 import sys
 import os
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-autoscaling = boto3.client('autoscaling')
-ec2 = boto3.client('ec2')
-route53 = boto3.client('route53')
+# Route53 and EC2 throttle under scaling storms, so back off adaptively
+# Attempts are capped so the retries fit within the function's 30s timeout
+client_config = Config(retries={'max_attempts': 5, 'mode': 'adaptive'})
+
+session = boto3.session.Session()
+autoscaling = session.client('autoscaling', config=client_config)
+ec2 = session.client('ec2', config=client_config)
+route53 = session.client('route53', config=client_config)
+
+# Shared across warm invocations, used to overlap independent API calls
+executor = ThreadPoolExecutor(max_workers=4)
 
 HOSTNAME_TAG_NAME = "asg:hostname_pattern"
 
+# How long (in seconds) looked up metadata is reused across warm invocations
+CACHE_TTL = 300
+
+# ASG name -> (timestamp, tag value)
+tag_cache = {}
+
 LIFECYCLE_KEY = "LifecycleHookName"
 ASG_KEY = "AutoScalingGroupName"
 
 # Fetches IP of an instance via EC2 API
 def fetch_ip_from_ec2(instance_id):
-    logger.info("Fetching IP for instance-id: %s", instance_id)
+    logger.debug("Fetching IP for instance-id: %s", instance_id)
     ec2_response = ec2.describe_instances(InstanceIds=[instance_id])
     if 'USE_PUBLIC_IP' in os.environ and os.environ['USE_PUBLIC_IP'] == "true":
         ip_address = ec2_response['Reservations'][0]['Instances'][0]['PublicIpAddress']
@@ -29,33 +47,57 @@ def fetch_ip_from_ec2(instance_id):
 
     return ip_address
 
+# Builds the fully qualified form of a hostname as Route53 returns it
+def canonicalize_hostname(hostname):
+    return hostname.rstrip('.').lower() + '.'
+
 # Fetches IP of an instance via route53 API
-def fetch_ip_from_route53(hostname, zone_id):
-    logger.info("Fetching IP for hostname: %s", hostname)
+# Expects a canonical hostname, returns None if there is no A record for it
+def fetch_ip_from_route53(canonical_hostname, zone_id):
+    logger.debug("Fetching IP for hostname: %s", canonical_hostname)
 
-    ip_address = route53.list_resource_record_sets(
+    record_sets = route53.list_resource_record_sets(
         HostedZoneId=zone_id,
-        StartRecordName=hostname,
+        StartRecordName=canonical_hostname,
         StartRecordType='A',
         MaxItems='1'
-    )['ResourceRecordSets'][0]['ResourceRecords'][0]['Value']
+    )['ResourceRecordSets']
+
+    # Listing starts at the given name, so the first record set is either ours or the next one in the zone
+    if not record_sets or record_sets[0]['Name'] != canonical_hostname or record_sets[0]['Type'] != 'A':
+        logger.info("No A record found for hostname %s", canonical_hostname)
+        return None
 
-    logger.info("Found IP for hostname %s: %s", hostname, ip_address)
+    ip_address = record_sets[0]['ResourceRecords'][0]['Value']
+
+    logger.info("Found IP for hostname %s: %s", canonical_hostname, ip_address)
 
     return ip_address
 
 # Fetches relevant tags from ASG
 # Returns tuple of hostname_pattern, zone_id
 def fetch_tag_metadata(asg_name):
-    logger.info("Fetching tags for ASG: %s", asg_name)
+    cached = tag_cache.get(asg_name)
+    if cached is not None and time.monotonic() - cached[0] < CACHE_TTL:
+        return cached[1].split("@")
+
+    logger.debug("Fetching tags for ASG: %s", asg_name)
 
-    tag_value = autoscaling.describe_tags(
+    tags = autoscaling.describe_tags(
         Filters=[
             {'Name': 'auto-scaling-group','Values': [asg_name]},
             {'Name': 'key','Values': [HOSTNAME_TAG_NAME]}
         ],
         MaxRecords=1
-    )['Tags'][0]['Value']
+    )['Tags']
+
+    # Also empty when the ASG itself doesn't exist
+    if not tags:
+        raise ValueError("No %s tag found for auto scaling group %s" % (HOSTNAME_TAG_NAME, asg_name))
+
+    tag_value = tags[0]['Value']
+
+    tag_cache[asg_name] = (time.monotonic(), tag_value)
 
     logger.info("Found tags for ASG %s: %s", asg_name, tag_value)
 
@@ -81,29 +123,37 @@ def update_name_tag(instance_id, hostname):
         ]
     )
 
-# Updates a Route53 record
-def update_record(zone_id, ip, hostname, operation):
-    logger.info("Changing record with %s for %s -> %s in %s", operation, hostname, ip, zone_id)
+# Builds a single Route53 record change
+def build_change(ip, hostname, operation):
+    return {
+        'Action': operation,
+        'ResourceRecordSet': {
+            'Name': hostname,
+            'Type': 'A',
+            'TTL': os.environ['ROUTE53_TTL'],
+            'ResourceRecords': [{'Value': ip}]
+        }
+    }
+
+# Updates Route53 records
+# All changes for a zone are sent in one batch
+def update_records(zone_id, changes):
+    logger.info("Changing %d records in %s", len(changes), zone_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        for change in changes:
+            record_set = change['ResourceRecordSet']
+            logger.debug("Changing record with %s for %s -> %s in %s", change['Action'], record_set['Name'], record_set['ResourceRecords'][0]['Value'], zone_id)
     route53.change_resource_record_sets(
         HostedZoneId=zone_id,
         ChangeBatch={
-            'Changes': [
-                {
-                    'Action': operation,
-                    'ResourceRecordSet': {
-                        'Name': hostname,
-                        'Type': 'A',
-                        'TTL': os.environ['ROUTE53_TTL'],
-                        'ResourceRecords': [{'Value': ip}]
-                    }
-                }
-            ]
+            'Changes': changes
         }
     )
 
 # Processes a scaling event
-# Builds a hostname from tag metadata, fetches a IP, and updates records accordingly
-def process_message(message):
+# Builds a hostname from tag metadata, fetches a IP, and returns the zone and record change to apply
+# pending_changes holds the changes of earlier records in this delivery that weren't sent yet, per zone and hostname
+def process_message(message, pending_changes):
     if 'LifecycleTransition' not in message:
         logger.info("Processing %s event", message['Event'])
         return
@@ -119,34 +169,33 @@ def process_message(message):
     asg_name = message['AutoScalingGroupName']
     instance_id =  message['EC2InstanceId']
 
+    # The instance IP doesn't depend on the ASG tags, so look both up at once
+    if operation == "UPSERT":
+        ip_future = executor.submit(fetch_ip_from_ec2, instance_id)
+
     hostname_pattern, zone_id = fetch_tag_metadata(asg_name)
     hostname = build_hostname(hostname_pattern, instance_id)
+    canonical_hostname = canonicalize_hostname(hostname)
 
     if operation == "UPSERT":
-        ip = fetch_ip_from_ec2(instance_id)
+        ip = ip_future.result()
 
         update_name_tag(instance_id, hostname)
     else:
-        ip = fetch_ip_from_route53(hostname, zone_id)
-
-    update_record(zone_id, ip, hostname, operation)
+        # Route53 can't see a change still pending from an earlier record, so cancel it
+        # and delete whatever record existed before, leaving the hostname absent either way
+        pending_changes.get(zone_id, {}).pop(canonical_hostname, None)
 
-# Picks out the message from a SNS message and deserializes it
-def process_record(record):
-    process_message(json.loads(record['Sns']['Message']))
-
-# Main handler where the SNS events end up to
-# Events are bulked up, so process each Record individually
-def lambda_handler(event, context):
-    logger.info("Processing SNS event: " + json.dumps(event))
+        ip = fetch_ip_from_route53(canonical_hostname, zone_id)
+        if ip is None:
+            return None
 
-    for record in event['Records']:
-        process_record(record)
+    return zone_id, build_change(ip, canonical_hostname, operation)
 
-# Finish the asg lifecycle operation by sending a continue result
+# Finishes the asg lifecycle operation by sending a continue result
+def complete_lifecycle_action(message):
     logger.info("Finishing ASG action")
-    message =json.loads(record['Sns']['Message'])
-    if LIFECYCLE_KEY in message and ASG_KEY in message :
+    try:
         response = autoscaling.complete_lifecycle_action (
             LifecycleHookName = message['LifecycleHookName'],
             AutoScalingGroupName = message['AutoScalingGroupName'],
@@ -155,9 +204,67 @@ def lambda_handler(event, context):
             LifecycleActionResult = 'CONTINUE'
 
         )
-        logger.info("ASG action complete: %s", response)
-    else :
-        logger.error("No valid JSON message")
+    except ClientError as error:
+        # A retried delivery finds the actions that succeeded the first time already completed
+        if error.response['Error']['Code'] == 'ValidationError' and 'No active Lifecycle Action found' in error.response['Error']['Message']:
+            logger.info("ASG action for instance-id %s was already completed", message['EC2InstanceId'])
+            return
+        raise
+    logger.info("ASG action complete: %s", response)
+
+# Main handler where the SNS events end up to
+# Events are bulked up, so process each Record individually,
+# coalesce the resulting record changes and send them in one batch per zone
+def lambda_handler(event, context):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Processing SNS event: %s", json.dumps(event))
+
+    changes = {}
+    zone_asgs = {}
+    lifecycle_messages = []
+    for record in event['Records']:
+        message = json.loads(record['Sns']['Message'])
+        try:
+            result = process_message(message, changes)
+        except ClientError:
+            # The cached tags may point at a zone or pattern that changed since
+            tag_cache.pop(message.get(ASG_KEY), None)
+            raise
+        if result is not None:
+            zone_id, change = result
+            # An UPSERT supersedes a pending change for the same record, a DELETE already cancelled it
+            changes.setdefault(zone_id, {})[change['ResourceRecordSet']['Name']] = change
+            zone_asgs.setdefault(zone_id, set()).add(message[ASG_KEY])
+
+        if LIFECYCLE_KEY in message and ASG_KEY in message:
+            lifecycle_messages.append(message)
+        else:
+            logger.error("No valid JSON message")
+
+    for zone_id, zone_changes in changes.items():
+        # Changes that cancelled each other out may leave nothing to send
+        if zone_changes:
+            try:
+                update_records(zone_id, list(zone_changes.values()))
+            except ClientError:
+                for asg_name in zone_asgs[zone_id]:
+                    tag_cache.pop(asg_name, None)
+                raise
+
+    # Lifecycle actions are independent of each other, so finish them concurrently
+    # Every action gets its attempt, then the first failure fails the invocation so it is retried
+    futures = [executor.submit(complete_lifecycle_action, message) for message in lifecycle_messages]
+    failure = None
+    for future in futures:
+        try:
+            future.result()
+        except Exception as error:
+            logger.exception("Failed to finish ASG action")
+            if failure is None:
+                failure = error
+
+    if failure is not None:
+        raise failure
 
 # if invoked manually, assume someone pipes in a event json
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('ROUTE53_TTL', '300')
+
+import autoscale
+
+ASG_NAME = "asg-1"
+ZONE_ID = "Z1"
+INSTANCE_ID = "i-1"
+HOSTNAME = "h-i-1.example.com."
+
+# Builds a SNS record carrying a lifecycle message for INSTANCE_ID
+def lifecycle_record(transition):
+    return {
+        'Sns': {
+            'Message': json.dumps({
+                'LifecycleTransition': transition,
+                'LifecycleHookName': 'hook',
+                'LifecycleActionToken': 'token-' + transition,
+                'AutoScalingGroupName': ASG_NAME,
+                'EC2InstanceId': INSTANCE_ID
+            })
+        }
+    }
+
+# Builds a list_resource_record_sets response holding a single A record
+def record_sets(name, ip):
+    return {
+        'ResourceRecordSets': [
+            {'Name': name, 'Type': 'A', 'ResourceRecords': [{'Value': ip}]}
+        ]
+    }
+
+class LambdaHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        autoscale.tag_cache.clear()
+
+        self.autoscaling = mock.MagicMock()
+        self.autoscaling.describe_tags.return_value = {
+            'Tags': [{'Key': autoscale.HOSTNAME_TAG_NAME, 'Value': 'h-#instanceid.example.com@' + ZONE_ID}]
+        }
+        self.ec2 = mock.MagicMock()
+        self.ec2.describe_instances.return_value = {
+            'Reservations': [{'Instances': [{'PrivateIpAddress': '10.0.0.1'}]}]
+        }
+        self.route53 = mock.MagicMock()
+
+        for name in ('autoscaling', 'ec2', 'route53'):
+            patcher = mock.patch.object(autoscale, name, getattr(self, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sent_changes(self):
+        return [call.kwargs['ChangeBatch']['Changes'] for call in self.route53.change_resource_record_sets.call_args_list]
+
+    def test_launch_then_launch_error_leaves_no_record(self):
+        # The hostname doesn't exist yet, listing returns the next record in the zone
+        self.route53.list_resource_record_sets.return_value = record_sets("other.example.com.", '10.0.0.9')
+
+        autoscale.lambda_handler({'Records': [
+            lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING"),
+            lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCH_ERROR")
+        ]}, None)
+
+        self.assertEqual(self.sent_changes(), [])
+        self.assertEqual(self.autoscaling.complete_lifecycle_action.call_count, 2)
+
+    def test_launch_then_terminate_deletes_existing_record(self):
+        # A record left behind for the hostname must end up deleted, not overwritten
+        self.route53.list_resource_record_sets.return_value = record_sets(HOSTNAME, '10.0.0.9')
+
+        autoscale.lambda_handler({'Records': [
+            lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING"),
+            lifecycle_record("autoscaling:EC2_INSTANCE_TERMINATING")
+        ]}, None)
+
+        changes = self.sent_changes()
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(len(changes[0]), 1)
+        self.assertEqual(changes[0][0]['Action'], "DELETE")
+        self.assertEqual(changes[0][0]['ResourceRecordSet']['Name'], HOSTNAME)
+        self.assertEqual(changes[0][0]['ResourceRecordSet']['ResourceRecords'], [{'Value': '10.0.0.9'}])
+        self.assertEqual(self.autoscaling.complete_lifecycle_action.call_count, 2)
+
+    def test_launch_upserts_record(self):
+        autoscale.lambda_handler({'Records': [
+            lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING")
+        ]}, None)
+
+        changes = self.sent_changes()
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0][0]['Action'], "UPSERT")
+        self.assertEqual(changes[0][0]['ResourceRecordSet']['ResourceRecords'], [{'Value': '10.0.0.1'}])
+        self.route53.list_resource_record_sets.assert_not_called()
+
+    def test_failed_lifecycle_action_fails_invocation(self):
+        self.route53.list_resource_record_sets.return_value = record_sets(HOSTNAME, '10.0.0.9')
+        self.autoscaling.complete_lifecycle_action.side_effect = [RuntimeError("throttled"), {}]
+
+        with self.assertRaises(RuntimeError):
+            autoscale.lambda_handler({'Records': [
+                lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING"),
+                lifecycle_record("autoscaling:EC2_INSTANCE_TERMINATING")
+            ]}, None)
+
+        # The other action is still attempted before the invocation fails
+        self.assertEqual(self.autoscaling.complete_lifecycle_action.call_count, 2)
+
+    def test_already_completed_lifecycle_action_is_ignored(self):
+        # On a retried delivery the action that succeeded the first time is no longer active
+        self.route53.list_resource_record_sets.return_value = record_sets(HOSTNAME, '10.0.0.9')
+        self.autoscaling.complete_lifecycle_action.side_effect = [
+            ClientError({'Error': {'Code': 'ValidationError', 'Message': 'No active Lifecycle Action found with instance ID i-1'}}, 'CompleteLifecycleAction'),
+            {}
+        ]
+
+        autoscale.lambda_handler({'Records': [
+            lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING"),
+            lifecycle_record("autoscaling:EC2_INSTANCE_TERMINATING")
+        ]}, None)
+
+        self.assertEqual(self.autoscaling.complete_lifecycle_action.call_count, 2)
+
+    def test_tags_are_reused_within_cache_ttl(self):
+        launch = {'Records': [lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING")]}
+
+        autoscale.lambda_handler(launch, None)
+        autoscale.lambda_handler(launch, None)
+
+        self.assertEqual(self.autoscaling.describe_tags.call_count, 1)
+
+    def test_tags_are_refetched_after_route53_error(self):
+        launch = {'Records': [lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING")]}
+        self.route53.change_resource_record_sets.side_effect = [
+            ClientError({'Error': {'Code': 'NoSuchHostedZone', 'Message': 'No hosted zone found'}}, 'ChangeResourceRecordSets'),
+            {}
+        ]
+
+        with self.assertRaises(ClientError):
+            autoscale.lambda_handler(launch, None)
+        autoscale.lambda_handler(launch, None)
+
+        self.assertEqual(self.autoscaling.describe_tags.call_count, 2)
+
+    def test_missing_hostname_tag_names_the_asg(self):
+        self.autoscaling.describe_tags.return_value = {'Tags': []}
+
+        with self.assertRaisesRegex(ValueError, ASG_NAME):
+            autoscale.lambda_handler({'Records': [
+                lifecycle_record("autoscaling:EC2_INSTANCE_LAUNCHING")
+            ]}, None)
+
+        self.assertNotIn(ASG_NAME, autoscale.tag_cache)
+
+if __name__ == "__main__":
+    unittest.main()